@@ -1,12 +1,22 @@
+import os
+
+# /var/task is read-only on Lambda, so point numba's JIT cache at /tmp
+# before numba is imported (directly or via matchering's dependencies)
+os.environ.setdefault("NUMBA_CACHE_DIR", "/tmp")
+
 import json
 import matchering as mg
-import os
-from pydub import AudioSegment
-from io import BytesIO
+import numba
+import numpy as np
+import soundfile as sf
 import boto3
+from boto3.s3.transfer import TransferConfig
 import requests
-import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import botocore.config
 import botocore.exceptions
+import concurrent.futures
 import logging
 from dotenv import load_dotenv
 
@@ -23,65 +33,123 @@ region_name = os.getenv("region_name")
 webhook_url = os.getenv("webhook_url")
 
 # Create AWS clients
-s3_client = boto3.client('s3', region_name=region_name)
+s3_client = boto3.client(
+    's3',
+    region_name=region_name,
+    config=botocore.config.Config(
+        max_pool_connections=32,
+        tcp_keepalive=True,
+        retries={'max_attempts': 10, 'mode': 'adaptive'},
+        connect_timeout=3,
+        read_timeout=30
+    )
+)
+
+# Thread pool for concurrent S3 transfers (boto3 clients are thread-safe)
+POOL = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+# Multipart threaded transfers for WAV files above a few MB
+TRANSFER_CFG = TransferConfig(
+    multipart_threshold=5 * 1024 * 1024,
+    multipart_chunksize=5 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True
+)
 
 # Lambda constants
 LAMBDA_STATIC_REFERENCE_WAV_PATH = "static/audio/reference.wav"
 LOCAL_REFERENCE_PATH = "/tmp/reference.wav"
-LOCAL_INSTRUMENTAL_PATH = "/tmp/instrumental.wav"
-LOCAL_FINAL_FILE = None
-LOCAL_VOCALS_PATH = None
+
+# ETag of the cached reference file, kept across warm invocations
+_reference_etag = None
+
+# Shared webhook session so start/end notifications reuse one TCP+TLS connection
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=Retry(total=3, backoff_factor=0.2)))
+_session.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=Retry(total=3, backoff_factor=0.2)))
+
+# Instrumental S3 keys per track ID, built once at import time
+TRACK_FILENAMES = {
+    1: "static/audio/pop_track1.wav",
+    2: "static/audio/norteno_track2.wav",
+    3: "static/audio/urbano_track3.wav"
+}
 
 def get_dynamic_s3_paths(track_id):
-    """Construct dynamic paths for instrumental files based on track ID."""
-    TRACK_FILENAMES = {
-        1: "pop_track1.wav",
-        2: "norteno_track2.wav",
-        3: "urbano_track3.wav"
-    }
-    track_filename = TRACK_FILENAMES.get(track_id, None)
-    if not track_filename:
+    """Look up the instrumental S3 key for the given track ID."""
+    try:
+        return TRACK_FILENAMES[track_id]
+    except KeyError:
         raise ValueError(f"Invalid trackID: {track_id}")
-    return f"static/audio/{track_filename}"
-
-def initialize_s3_paths(track_id):
-    """Initialize the global path for instrumental files dynamically."""
-    global LAMBDA_STATIC_INSTRUMENTAL_WAV_PATH
-    LAMBDA_STATIC_INSTRUMENTAL_WAV_PATH = get_dynamic_s3_paths(track_id)
 
 def upload_file_to_s3(local_file, bucket, key):
     """Upload the specified file to S3."""
     try:
         logger.info(f"Uploading {local_file} to s3://{bucket}/{key}...")
-        s3_client.upload_file(local_file, bucket, key)
+        with open(local_file, 'rb') as file_obj:
+            s3_client.upload_fileobj(file_obj, bucket, key, Config=TRANSFER_CFG)
         logger.info(f"File {local_file} uploaded successfully.")
     except Exception as e:
         logger.error(f"Error uploading file to S3: {e}")
         raise
 
-def wait_for_file(bucket, key, s3_client, timeout=10, interval=5):
+def wait_for_file(bucket, key, s3_client, timeout=10):
     """Wait for the specified file to become available in S3."""
-    elapsed_time = 0
-    while elapsed_time < timeout:
-        try:
-            s3_client.head_object(Bucket=bucket, Key=key)
-            logger.info(f"File {key} is now available in bucket {bucket}.")
-            return True
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == '404':
-                logger.info(f"Waiting for file {key} in bucket {bucket}...")
-                time.sleep(interval)
-                elapsed_time += interval
-            else:
-                raise e
-    logger.error(f"File {key} did not become available within the timeout period.")
-    return False
+    try:
+        s3_client.get_waiter('object_exists').wait(
+            Bucket=bucket,
+            Key=key,
+            WaiterConfig={'Delay': 2, 'MaxAttempts': max(timeout // 2, 1)}
+        )
+        logger.info(f"File {key} is now available in bucket {bucket}.")
+        return True
+    except botocore.exceptions.WaiterError:
+        logger.error(f"File {key} did not become available within the timeout period.")
+        return False
+
+def fetch_file_from_s3(key, local_path):
+    """Wait for the given key to exist, then download it to local storage.
+
+    Only needed for dynamic keys (vocals) that may still be uploading
+    from a prior pipeline stage.
+    """
+    if not wait_for_file(bucket_name, key, s3_client):
+        raise Exception(f"File not available within timeout: {key}")
+    download_file_from_s3(bucket_name, key, local_path, s3_client)
+
+def fetch_cached_file_from_s3(key, local_path):
+    """Download a static asset unless a copy already sits in /tmp from a warm start.
+
+    Static assets exist in S3 from deployment, so no existence pre-check
+    is made; a missing key surfaces as an error on the download itself.
+    """
+    if os.path.exists(local_path) and os.path.getsize(local_path) > 0:
+        logger.info(f"Using cached copy of {key} at {local_path}.")
+        return
+    try:
+        download_file_from_s3(bucket_name, key, local_path, s3_client)
+    except botocore.exceptions.ClientError as e:
+        raise Exception(f"Static file missing from S3: {key}") from e
+
+def fetch_reference_from_s3():
+    """Download the reference file, reusing the warm-start copy while its ETag matches."""
+    global _reference_etag
+    etag = s3_client.head_object(
+        Bucket=bucket_name, Key=LAMBDA_STATIC_REFERENCE_WAV_PATH
+    )['ETag']
+    if (etag == _reference_etag
+            and os.path.exists(LOCAL_REFERENCE_PATH)
+            and os.path.getsize(LOCAL_REFERENCE_PATH) > 0):
+        logger.info("Using cached reference file.")
+        return
+    download_file_from_s3(bucket_name, LAMBDA_STATIC_REFERENCE_WAV_PATH, LOCAL_REFERENCE_PATH, s3_client)
+    _reference_etag = etag
 
 def download_file_from_s3(bucket, key, local_output_file, s3_client):
     """Download the specified file from S3 to local storage."""
     try:
         logger.info(f"Downloading {key} from S3...")
-        s3_client.download_file(bucket, key, local_output_file)
+        s3_client.download_file(bucket, key, local_output_file, Config=TRANSFER_CFG)
         logger.info(f"File downloaded to {local_output_file}")
     except Exception as e:
         logger.error(f"Error downloading file: {e}")
@@ -95,17 +163,17 @@ def process_files(vocals_path, instrumental_path, output_path, reference_path):
     logger.info(f"Output Path: {output_path}")
     logger.info(f"Reference Path: {reference_path}")
 
+    mixed_path = "/tmp/mixed.wav"
     try:
         mixed_audio = mix_tracks(vocals_path, instrumental_path)
         if mixed_audio is None:
             raise ValueError("Failed to mix audio tracks.")
 
-        mixed_buffer = BytesIO()
-        mixed_audio.export(mixed_buffer, format="wav")
-        mixed_buffer.seek(0)
+        mixed_samples, sample_rate = mixed_audio
+        sf.write(mixed_path, mixed_samples, sample_rate)
 
         mg.process(
-            target=mixed_buffer,
+            target=mixed_path,
             reference=reference_path,
             results=[mg.pcm24(output_path)]
         )
@@ -115,23 +183,97 @@ def process_files(vocals_path, instrumental_path, output_path, reference_path):
         logger.error(f"An error occurred during processing: {e}")
         raise
 
+    finally:
+        # The intermediate mix is only needed by mg.process; /tmp is RAM-backed
+        if os.path.exists(mixed_path):
+            os.remove(mixed_path)
+
+@numba.njit(parallel=True, cache=True)
+def _mix_clip(vocals, instrumental, out):
+    """Fused int32 sum + clip + int16 cast in one pass over the samples.
+
+    All three arrays must share the same (frames, channels) shape.
+    """
+    for k in numba.prange(out.shape[0]):
+        for c in range(out.shape[1]):
+            s = np.int32(vocals[k, c]) + np.int32(instrumental[k, c])
+            if s < -32768:
+                s = -32768
+            elif s > 32767:
+                s = 32767
+            out[k, c] = s
+
 def mix_tracks(vocals_path, instrumental_path):
-    """Mix vocals and instrumental into one track and return the mixed AudioSegment."""
+    """Mix vocals and instrumental and return the (samples, sample_rate) result."""
     try:
-        vocals = AudioSegment.from_wav(vocals_path)
-        instrumental = AudioSegment.from_wav(instrumental_path)
-
-        if len(vocals) < len(instrumental):
-            silence = AudioSegment.silent(duration=len(instrumental) - len(vocals))
-            vocals = vocals + silence
-        elif len(vocals) > len(instrumental):
-            vocals = vocals[:len(instrumental)]
-
-        return vocals.overlay(instrumental)
+        vocals, vocals_rate = sf.read(vocals_path, dtype='int16', always_2d=True)
+        instrumental, instrumental_rate = sf.read(instrumental_path, dtype='int16', always_2d=True)
+
+        if vocals_rate != instrumental_rate:
+            raise ValueError(
+                f"Sample rate mismatch: vocals at {vocals_rate}Hz, "
+                f"instrumental at {instrumental_rate}Hz"
+            )
+
+        length = instrumental.shape[0]
+        if vocals.shape[0] < length:
+            vocals = np.pad(vocals, ((0, length - vocals.shape[0]), (0, 0)))
+        elif vocals.shape[0] > length:
+            vocals = vocals[:length]
+
+        # Match channel layouts before the kernel: duplicate a mono side up
+        # to the other side's channel count, as the broadcast add used to do
+        if vocals.shape[1] != instrumental.shape[1]:
+            if vocals.shape[1] == 1:
+                vocals = np.repeat(vocals, instrumental.shape[1], axis=1)
+            elif instrumental.shape[1] == 1:
+                instrumental = np.repeat(instrumental, vocals.shape[1], axis=1)
+            else:
+                raise ValueError(
+                    f"Channel mismatch: vocals has {vocals.shape[1]} channels, "
+                    f"instrumental has {instrumental.shape[1]}"
+                )
+
+        # Sum in int32 to avoid overflow, then clip back to the int16 range
+        mixed = np.empty_like(instrumental)
+        _mix_clip(vocals, instrumental, mixed)
+        return mixed, instrumental_rate
     except Exception as e:
         logger.error(f"Error mixing tracks: {e}")
         return None
 
+def _warm_start():
+    """Run a tiny mastering pass at import time.
+
+    matchering pulls in numba-backed dependencies whose JIT compilation
+    would otherwise hit the first real invocation; doing a one-second
+    dummy run here moves that cost into the Lambda init phase.
+    """
+    warm_target = "/tmp/warmup_target.wav"
+    warm_reference = "/tmp/warmup_reference.wav"
+    warm_result = "/tmp/warmup_result.wav"
+    try:
+        t = np.linspace(0, 1.0, 44100, endpoint=False)
+        target = np.column_stack(((np.sin(2 * np.pi * 440.0 * t) * 8192).astype(np.int16),) * 2)
+        reference = np.column_stack(((np.sin(2 * np.pi * 220.0 * t) * 16384).astype(np.int16),) * 2)
+        _mix_clip(target, reference, np.empty_like(target))
+        sf.write(warm_target, target, 44100)
+        sf.write(warm_reference, reference, 44100)
+        mg.process(
+            target=warm_target,
+            reference=warm_reference,
+            results=[mg.pcm24(warm_result)]
+        )
+        logger.info("Cold-start warm-up completed.")
+    except Exception as e:
+        logger.warning(f"Cold-start warm-up failed: {e}")
+    finally:
+        for file_path in [warm_target, warm_reference, warm_result]:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+_warm_start()
+
 def notify_system_api(song_id, stage, action, file_name=None, err_msg=None):
     """Send a status update to the webhook API."""
     try:
@@ -143,9 +285,9 @@ def notify_system_api(song_id, stage, action, file_name=None, err_msg=None):
             "errMsg": err_msg
         }
 
-        print(payload)
+        logger.debug("notify payload: %s", payload)
 
-        response = requests.post(webhook_url, json=payload)
+        response = _session.post(webhook_url, json=payload, timeout=5)
         response.raise_for_status()
         logger.info(f"Webhook notified successfully: {action} for songID {song_id}.")
     except requests.exceptions.RequestException as e:
@@ -154,13 +296,15 @@ def notify_system_api(song_id, stage, action, file_name=None, err_msg=None):
 def lambda_handler(event, context):
     """AWS Lambda handler function."""
     logger.info("Starting Lambda execution...")
-    logger.info(f"Event: {json.dumps(event, indent=4)}")
+    logger.info("Event: %s", event)
 
     song_id = 0
-
-    
+    cleanup_paths = []
+    upload_futures = []
 
     try:
+        # First pass: parse every record so shared downloads can be deduped
+        jobs = []
         for record in event['Records']:
             body = json.loads(record['body'])
             song_id = body.get("songID")
@@ -170,47 +314,69 @@ def lambda_handler(event, context):
             if not track_id:
                 raise ValueError("Region or track ID is missing.")
 
-            initialize_s3_paths(track_id)
-
-            if not LAMBDA_STATIC_INSTRUMENTAL_WAV_PATH:
-                raise ValueError("LAMBDA_STATIC_INSTRUMENTAL_WAV_PATH is not set.")
-
-            local_final_file = f"/tmp/final_song_{song_id}.wav"
-            local_vocals_path = f"/tmp/vocals_{song_id}.wav"
-            lambda_vocals_path = f"utau_inference/{file_name}"
+            jobs.append({
+                "song_id": song_id,
+                "track_id": track_id,
+                "instrumental_key": get_dynamic_s3_paths(track_id),
+                "local_final_file": f"/tmp/final_song_{song_id}.wav",
+                "local_vocals_path": f"/tmp/vocals_{song_id}.wav",
+                "local_instrumental_path": f"/tmp/instrumental_{track_id}.wav",
+                "lambda_vocals_path": f"utau_inference/{file_name}"
+            })
+            cleanup_paths += [jobs[-1]["local_vocals_path"], jobs[-1]["local_final_file"]]
+
+        # Fetch the reference once, each unique instrumental once, and every
+        # vocals file, all concurrently; pair each future with the first
+        # record that needs it so failures are blamed on the right song
+        fetch_futures = []
+        if jobs:
+            fetch_futures.append((jobs[0], POOL.submit(fetch_reference_from_s3)))
+        fetched_instrumentals = set()
+        for job in jobs:
+            if job["instrumental_key"] not in fetched_instrumentals:
+                fetched_instrumentals.add(job["instrumental_key"])
+                fetch_futures.append((job, POOL.submit(fetch_cached_file_from_s3, job["instrumental_key"], job["local_instrumental_path"])))
+            fetch_futures.append((job, POOL.submit(fetch_file_from_s3, job["lambda_vocals_path"], job["local_vocals_path"])))
+        concurrent.futures.wait([future for _, future in fetch_futures])
+        for job, future in fetch_futures:
+            # Re-bind song_id so a failed fetch is reported against its own record
+            song_id = job["song_id"]
+            future.result()
+
+        # Second pass: mix and master each record, handing every finished file
+        # to the pool so its upload overlaps with mastering the next record
+        def upload_and_notify(job):
+            final_name = f"final_song_{job['song_id']}_{job['track_id']}.wav"
+            upload_file_to_s3(job["local_final_file"], bucket_name, f"matchering/{final_name}")
+            notify_system_api(job["song_id"], "matchering", "end", file_name=final_name, err_msg=None)
+
+        for job in jobs:
+            song_id = job["song_id"]
 
             notify_system_api(song_id, "matchering", "start", file_name=None, err_msg=None)
 
+            process_files(job["local_vocals_path"], job["local_instrumental_path"], job["local_final_file"], LOCAL_REFERENCE_PATH)
 
-            if wait_for_file(bucket_name, LAMBDA_STATIC_REFERENCE_WAV_PATH, s3_client):
-                download_file_from_s3(bucket_name, LAMBDA_STATIC_REFERENCE_WAV_PATH, LOCAL_REFERENCE_PATH, s3_client)
-            else:
-                raise Exception("Reference file not available within timeout")
-
-            if wait_for_file(bucket_name, LAMBDA_STATIC_INSTRUMENTAL_WAV_PATH, s3_client):
-                download_file_from_s3(bucket_name, LAMBDA_STATIC_INSTRUMENTAL_WAV_PATH, LOCAL_INSTRUMENTAL_PATH, s3_client)
-            else:
-                raise Exception("Instrumental file not available within timeout")
-
-            if wait_for_file(bucket_name, lambda_vocals_path, s3_client):
-                download_file_from_s3(bucket_name, lambda_vocals_path, local_vocals_path, s3_client)
-            else:
-                raise Exception(f"Vocals file not available: {lambda_vocals_path}")
-
-            process_files(local_vocals_path, LOCAL_INSTRUMENTAL_PATH, local_final_file, LOCAL_REFERENCE_PATH)
-
-            upload_file_to_s3(local_final_file, bucket_name, f"matchering/final_song_{song_id}_{track_id}.wav")
-
-            notify_system_api(song_id, "matchering", "end", file_name=f"final_song_{song_id}_{track_id}.wav", err_msg=None)
+            upload_futures.append((job, POOL.submit(upload_and_notify, job)))
 
     except Exception as e:
         logger.error(f"Error in lambda_handler: {e}")
         notify_system_api(song_id, "matchering", "error", None, str(e))
 
     finally:
-        # Clean up temporary files
-        for file_path in [LOCAL_VOCALS_PATH, LOCAL_FINAL_FILE, LOCAL_REFERENCE_PATH, LOCAL_INSTRUMENTAL_PATH]:
-            if file_path and os.path.exists(file_path):
+        # Join every submitted upload before touching its file, even when a
+        # later record failed mid-batch; completed masters still get uploaded
+        # and each failed upload reports against its own song
+        concurrent.futures.wait([future for _, future in upload_futures])
+        for job, future in upload_futures:
+            upload_error = future.exception()
+            if upload_error is not None:
+                logger.error(f"Upload failed for songID {job['song_id']}: {upload_error}")
+                notify_system_api(job["song_id"], "matchering", "error", None, str(upload_error))
+
+        # Clean up per-invocation temp files; the reference and instrumentals stay cached for warm starts
+        for file_path in cleanup_paths:
+            if os.path.exists(file_path):
                 try:
                     os.remove(file_path)
                     logger.info(f"Deleted temporary file: {file_path}")